@@ -21,37 +21,95 @@ from __future__ import print_function
 import collections
 import copy
 import inspect
+import types
+import weakref
 
 from fire import inspectutils
 import six
 
 
-def Script(name, component, default_options=None, shell='bash'):
-  if shell == 'fish':
-    return _FishScript(name, _Commands(component), default_options)
-  return _BashScript(name, _Commands(component), default_options)
+# Per-component caches of arg specs and of generated completion scripts, keyed
+# by id(component). Each value is a (weakref to component,
+# result) tuple; the entry is evicted when the component is garbage collected,
+# so an id is never matched to a stale result.
+_ARGSPEC_CACHE = {}
+_SCRIPT_CACHE = {}
 
+# The kind of component (see _ComponentKind) of each type of component.
+_COMPONENT_KINDS = weakref.WeakKeyDictionary()
 
-def _BashScript(name, commands, default_options=None):
-  """Returns a Bash script registering a completion function for the commands.
+# The results of _FormatForCommand, which sees the same member names many times
+# while the commands of a component are collected. Bounded by clearing it.
+_FORMATTED_TOKENS = {}
+_MAX_FORMATTED_TOKENS = 4096
+
+# types.DynamicClassAttribute is only available in Python 3.4+.
+_DYNAMIC_CLASS_ATTRIBUTE = getattr(types, 'DynamicClassAttribute', None)  # pylint: disable=invalid-name
+
+# The type of namedtuple attributes, only available in Python 3.8+.
+_TUPLEGETTER = getattr(collections, '_tuplegetter', None)
+
+
+def _CachedForComponent(cache, component, compute):
+  """Returns compute(component), reusing the result stored in cache if any.
+
+  Components which cannot be weakly referenced are not cached.
 
   Args:
-    name: The first token in the commands, also the name of the command.
-    commands: A list of all possible commands that tab completion can complete
-        to. Each command is a list or tuple of the string tokens that make up
-        that command.
-    default_options: A dict of options that can be used with any command. Use
-        this if there are flags that can always be appended to a command.
+    cache: The dict in which to store results, keyed by id(component).
+    component: The component to compute the result for.
+    compute: A function of the component computing the result.
   Returns:
-    A string which is the Bash script. Source the bash script to enable tab
-    completion in Bash.
+    The result of compute(component).
+  """
+  key = id(component)
+  entry = cache.get(key)
+  if entry is not None and entry[0]() is component:
+    return entry[1]
+
+  result = compute(component)
+  try:
+    ref = weakref.ref(component, lambda unused_ref: cache.pop(key, None))
+  except TypeError:
+    return result  # The component is not weakly referenceable.
+  cache[key] = (ref, result)
+  return result
+
+
+def _GetFullArgSpec(component):
+  return _CachedForComponent(
+      _ARGSPEC_CACHE, component, inspectutils.GetFullArgSpec)
+
+
+def Script(name, component, default_options=None, shell='bash'):
+  """Returns a shell script registering tab completion for the component's CLI.
+
+  Scripts are memoized per component identity, so repeated calls for the same
+  component and arguments return the script generated by the first call. If
+  the component is mutated after that call, the memoized script is stale.
+
+  Args:
+    name: The name of the command, used as the first token of the commands.
+    component: The component considered to be the root of the commands.
+    default_options: A set of options that can be used with any command.
+    shell: The shell to generate the script for, 'bash' or 'fish'.
+  Returns:
+    A string which is the completion script for the shell.
   """
   default_options = default_options or set()
-  global_options, options_map, subcommands_map = _GetMaps(
-      name, commands, default_options
-  )
+  # The scripts already generated for the component, keyed by the arguments.
+  scripts = _CachedForComponent(_SCRIPT_CACHE, component, lambda unused: {})
+  key = (name, shell, frozenset(default_options))
+  if key not in scripts:
+    maps = _BuildMaps(name, component, default_options)
+    if shell == 'fish':
+      scripts[key] = _FishScriptFromMaps(name, *maps)
+    else:
+      scripts[key] = _BashScriptFromMaps(name, default_options, *maps)
+  return scripts[key]
 
-  bash_completion_template = """# bash completion support for {name}
+
+_BASH_COMPLETION_TEMPLATE = """# bash completion support for {name}
 # DO NOT EDIT.
 # This script is autogenerated by fire/completion.py.
 
@@ -128,87 +186,96 @@ is_prev_global()
 complete -F _complete-{identifier} {command}
 """
 
-  check_wrapper = """
+_BASH_CHECK_WRAPPER_TEMPLATE = """
   case "${{lastcommand}}" in
   {lastcommand_checks}
   esac"""
 
-  lastcommand_check_template = """
+# The opts assignment is part of each check template, so each command's check
+# is filled in with a single format call.
+_BASH_SUBCOMMAND_CHECK_TEMPLATE = """
     {command})
-      {opts_assignment}
-      opts=$(filter_options $opts)
-    ;;"""
-
-  opts_assignment_subcommand_template = """
       if is_prev_global; then
         opts="${{GLOBAL_OPTIONS}}"
       else
         opts="{options} ${{GLOBAL_OPTIONS}}"
-      fi"""
+      fi
+      opts=$(filter_options $opts)
+    ;;"""
 
-  opts_assignment_main_command_template = """
-      opts="{options} ${{GLOBAL_OPTIONS}}" """
+_BASH_MAIN_COMMAND_CHECK_TEMPLATE = """
+    {command})
+      opts="{options} ${{GLOBAL_OPTIONS}}"
+      opts=$(filter_options $opts)
+    ;;"""
 
-  def _GetOptsAssignmentTemplate(command):
-    if command == name:
-      return opts_assignment_main_command_template
-    else:
-      return opts_assignment_subcommand_template
 
-  lines = []
-  commands_set = set()
-  commands_set.add(name)
-  commands_set = commands_set.union(set(subcommands_map.keys()))
-  commands_set = commands_set.union(set(options_map.keys()))
+def _BashScript(name, commands, default_options=None):
+  """Returns a Bash script registering a completion function for the commands.
+
+  Args:
+    name: The first token in the commands, also the name of the command.
+    commands: A list of all possible commands that tab completion can complete
+        to. Each command is a list or tuple of the string tokens that make up
+        that command.
+    default_options: A dict of options that can be used with any command. Use
+        this if there are flags that can always be appended to a command.
+  Returns:
+    A string which is the Bash script. Source the bash script to enable tab
+    completion in Bash.
+  """
+  default_options = default_options or set()
+  global_options, options_map, subcommands_map, commands_set = _GetMaps(
+      name, commands, default_options
+  )
+  return _BashScriptFromMaps(name, default_options, global_options,
+                             options_map, subcommands_map, commands_set)
+
+
+def _BashScriptFromMaps(name, default_options, global_options, options_map,
+                        subcommands_map, commands_set):
+  """Returns a Bash script for the command maps computed by _GetMaps."""
+  # The completions offered after each command: its options and subcommands.
+  # Many commands share the same completions (e.g. the methods of a class
+  # reachable under several names), so each distinct set is joined only once.
+  joined_options = {}
+  command_options = {}
   for command in commands_set:
-    opts_assignment = _GetOptsAssignmentTemplate(command).format(
-        options=' '.join(
-            sorted(options_map[command].union(subcommands_map[command]))
-        ),
-    )
-    lines.append(
-        lastcommand_check_template.format(
-            command=command,
-            opts_assignment=opts_assignment)
-    )
+    options = frozenset(
+        options_map[command] | subcommands_map[command] | default_options)
+    if options not in joined_options:
+      joined_options[options] = ' '.join(sorted(options))
+    command_options[command] = joined_options[options]
+  # Everything is emitted in sorted order so that the script is deterministic.
+  lines = []
+  for command in sorted(commands_set):
+    if command == name:
+      check_template = _BASH_MAIN_COMMAND_CHECK_TEMPLATE
+    else:
+      check_template = _BASH_SUBCOMMAND_CHECK_TEMPLATE
+    lines.append(check_template.format(
+        command=command,
+        options=command_options[command],
+    ))
   lastcommand_checks = '\n'.join(lines)
 
-  checks = check_wrapper.format(
+  checks = _BASH_CHECK_WRAPPER_TEMPLATE.format(
       lastcommand_checks=lastcommand_checks,
   )
 
   return (
-      bash_completion_template.format(
+      _BASH_COMPLETION_TEMPLATE.format(
           name=name,
           command=name,
           checks=checks,
-          default_options=' '.join(default_options),
+          default_options=' '.join(sorted(default_options)),
           identifier=name.replace('/', '').replace('.', '').replace(',', ''),
-          global_options=' '.join(global_options),
+          global_options=' '.join(sorted(global_options)),
       )
   )
 
 
-def _FishScript(name, commands, default_options=None):
-  """Returns a Fish script registering a completion function for the commands.
-
-  Args:
-    name: The first token in the commands, also the name of the command.
-    commands: A list of all possible commands that tab completion can complete
-        to. Each command is a list or tuple of the string tokens that make up
-        that command.
-    default_options: A dict of options that can be used with any command. Use
-        this if there are flags that can always be appended to a command.
-  Returns:
-    A string which is the Fish script. Source the fish script to enable tab
-    completion in Fish.
-  """
-  default_options = default_options or set()
-  global_options, options_map, subcommands_map = _GetMaps(
-      name, commands, default_options
-  )
-
-  fish_source = """function __fish_using_command
+_FISH_HEADER_TEMPLATE = """function __fish_using_command
     set cmd (commandline -opc)
     for i in (seq (count $cmd) 1)
         switch $cmd[$i]
@@ -253,36 +320,83 @@ end
 
 """
 
-  subcommand_template = ("complete -c {name} -n '__fish_using_command "
-                         "{command}' -f -a {subcommand}\n")
-  flag_template = ("complete -c {name} -n "
-                   "'__fish_using_command {command};{prev_global_check} and "
-                   "__option_entered_check --{option}' -l {option}\n")
+_FISH_SUBCOMMAND_TEMPLATE = ("complete -c {name} -n '__fish_using_command "
+                             "{command}' -f -a {subcommand}\n")
+_FISH_FLAG_TEMPLATE = ("complete -c {name} -n "
+                       "'__fish_using_command {command};{prev_global_check} "
+                       "and __option_entered_check --{option}' -l {option}\n")
 
-  prev_global_check = ' and __is_prev_global;'
-  for command in set(subcommands_map.keys()).union(set(options_map.keys())):
-    for subcommand in subcommands_map[command]:
-      fish_source += subcommand_template.format(
+
+def _FishScript(name, commands, default_options=None):
+  """Returns a Fish script registering a completion function for the commands.
+
+  Args:
+    name: The first token in the commands, also the name of the command.
+    commands: A list of all possible commands that tab completion can complete
+        to. Each command is a list or tuple of the string tokens that make up
+        that command.
+    default_options: A dict of options that can be used with any command. Use
+        this if there are flags that can always be appended to a command.
+  Returns:
+    A string which is the Fish script. Source the fish script to enable tab
+    completion in Fish.
+  """
+  default_options = default_options or set()
+  global_options, options_map, subcommands_map, commands_set = _GetMaps(
+      name, commands, default_options
+  )
+  return _FishScriptFromMaps(
+      name, global_options, options_map, subcommands_map, commands_set)
+
+
+def _FishScriptFromMaps(name, global_options, options_map, subcommands_map,
+                        commands_set):
+  """Returns a Fish script for the command maps computed by _GetMaps."""
+  sorted_global_options = sorted(global_options)
+  # The header is formatted on its own, so that braces in the generated
+  # completion lines are not interpreted as format fields.
+  fish_source = [_FISH_HEADER_TEMPLATE.format(
+      global_options=' '.join(
+          '"{option}"'.format(option=option)
+          for option in sorted_global_options
+      )
+  )]
+
+  # The flag names, without their leading dashes, of the options seen so far.
+  flag_names = {}
+  # Everything is emitted in sorted order so that the script is deterministic.
+  for command in sorted(commands_set):
+    for subcommand in sorted(subcommands_map[command]):
+      fish_source.append(_FISH_SUBCOMMAND_TEMPLATE.format(
           name=name,
           command=command,
           subcommand=subcommand,
-      )
+      ))
 
-    for option in options_map[command].union(global_options):
-      check_needed = command != name
-      fish_source += flag_template.format(
+    if command != name:
+      prev_global_check = ' and __is_prev_global;'
+    else:
+      prev_global_check = ''
+    if options_map.get(command):
+      options = sorted(options_map[command] | global_options)
+    else:
+      options = sorted_global_options
+    for option in options:
+      if option not in flag_names:
+        # Strips the '--' prefix only; str.lstrip('--') would strip any number
+        # of leading dashes.
+        if option.startswith('--'):
+          flag_names[option] = option[2:]
+        else:
+          flag_names[option] = option.lstrip('-')
+      fish_source.append(_FISH_FLAG_TEMPLATE.format(
           name=name,
           command=command,
-          prev_global_check=prev_global_check if check_needed else '',
-          option=option.lstrip('--'),
-      )
+          prev_global_check=prev_global_check,
+          option=flag_names[option],
+      ))
 
-  return fish_source.format(
-      global_options=' '.join(
-          '"{option}"'.format(option=option)
-          for option in global_options
-      )
-  )
+  return ''.join(fish_source)
 
 
 def MemberVisible(component, name, member, class_attrs=None, verbose=False):
@@ -308,19 +422,27 @@ def MemberVisible(component, name, member, class_attrs=None, verbose=False):
   Returns
     A boolean value indicating whether the member should be included.
   """
-  if isinstance(name, six.string_types) and name.startswith('__'):
+  # The checks are ordered so that the cheap and most selective ones run first.
+  is_string_name = isinstance(name, six.string_types)
+  if is_string_name and name.startswith('__'):
     return False
   if verbose:
     return True
-  if (member is absolute_import
-      or member is division
-      or member is print_function):
+  if is_string_name and name.startswith('_'):
     return False
-  if isinstance(member, type(absolute_import)) and six.PY34:
+  if isinstance(member, type(absolute_import)):
+    # Hides __future__ features, e.g. absolute_import, division, print_function.
     return False
   if inspect.ismodule(member) and member is six:
     # TODO(dbieber): Determine more generally which modules to hide.
     return False
+  if (six.PY2 and inspect.isfunction(component)
+      and name in ('func_closure', 'func_code', 'func_defaults',
+                   'func_dict', 'func_doc', 'func_globals', 'func_name')):
+    return False
+  if (six.PY2 and inspect.ismethod(component)
+      and name in ('im_class', 'im_func', 'im_self')):
+    return False
   if inspect.isclass(component):
     # If class_attrs has not been provided, compute it.
     if class_attrs is None:
@@ -333,18 +455,9 @@ def MemberVisible(component, name, member, class_attrs=None, verbose=False):
         return False
       # Backward compatibility notes: Before Python 3.8, namedtuple attributes
       # were properties. In Python 3.8, they have type tuplegetter.
-      tuplegetter = getattr(collections, '_tuplegetter', type(None))
-      if isinstance(class_attr.object, tuplegetter):
+      if (_TUPLEGETTER is not None
+          and isinstance(class_attr.object, _TUPLEGETTER)):
         return False
-  if (six.PY2 and inspect.isfunction(component)
-      and name in ('func_closure', 'func_code', 'func_defaults',
-                   'func_dict', 'func_doc', 'func_globals', 'func_name')):
-    return False
-  if (six.PY2 and inspect.ismethod(component)
-      and name in ('im_class', 'im_func', 'im_self')):
-    return False
-  if isinstance(name, six.string_types):
-    return not name.startswith('_')
   return True  # Default to including the member
 
 
@@ -369,7 +482,7 @@ def VisibleMembers(component, class_attrs=None, verbose=False):
   if isinstance(component, dict):
     members = component.items()
   else:
-    members = inspect.getmembers(component)
+    members = _GetMembers(component, verbose=verbose)
 
   # If class_attrs has not been provided, compute it.
   if class_attrs is None:
@@ -381,6 +494,56 @@ def VisibleMembers(component, class_attrs=None, verbose=False):
   ]
 
 
+def _GetMembers(component, verbose=False):
+  """Returns the (member_name, member) pairs of the component, sorted by name.
+
+  This is like inspect.getmembers, except that names which MemberVisible
+  never includes are skipped before their attributes are looked up: names
+  starting with '__', and unless verbose, names starting with '_'. Looking
+  these up could run arbitrary property code.
+
+  Args:
+    component: The component whose members to list.
+    verbose: Whether to include private members.
+  Returns:
+    A list of tuples (member_name, member) of the members of the component.
+  """
+  member_names = dir(component)
+  mro = ()
+  if inspect.isclass(component):
+    mro = inspect.getmro(component)
+    if _DYNAMIC_CLASS_ATTRIBUTE is not None:
+      # As in inspect.getmembers, include the bases' DynamicClassAttributes
+      # (e.g. the name and value of an Enum), which dir() does not list.
+      for base in component.__bases__:
+        member_names.extend(
+            name for name, value in base.__dict__.items()
+            if isinstance(value, _DYNAMIC_CLASS_ATTRIBUTE))
+
+  hidden_prefix = '__' if verbose else '_'
+  members = []
+  processed = set()
+  for member_name in member_names:
+    if member_name in processed or (
+        isinstance(member_name, six.string_types)
+        and member_name.startswith(hidden_prefix)):
+      continue
+    processed.add(member_name)
+    try:
+      member = getattr(component, member_name)
+    except AttributeError:
+      # Fall back on the class dicts, as inspect.getmembers does.
+      for base in mro:
+        if member_name in base.__dict__:
+          member = base.__dict__[member_name]
+          break
+      else:
+        continue
+    members.append((member_name, member))
+  members.sort(key=lambda pair: pair[0])
+  return members
+
+
 def _CompletionsFromArgs(fn_args):
   """Takes a list of fn args and returns a list of the fn's completion strings.
 
@@ -396,6 +559,44 @@ def _CompletionsFromArgs(fn_args):
   return completions
 
 
+def _ComponentKind(component):
+  """Returns which kind of component, as far as completion is concerned, it is.
+
+  Each of these kinds is determined by the component's type, so the kind is
+  computed once per type and then looked up.
+
+  Args:
+    component: The component to classify.
+  Returns:
+    One of 'routine', 'class', 'sequence' (a tuple or list), 'generator' or
+    'other'.
+  """
+  component_type = type(component)
+  kind = _COMPONENT_KINDS.get(component_type)
+  if kind is not None:
+    return kind
+
+  if inspect.isroutine(component):
+    kind = 'routine'
+  elif inspect.isclass(component):
+    kind = 'class'
+  elif isinstance(component, (tuple, list)):
+    kind = 'sequence'
+  elif inspect.isgenerator(component):
+    kind = 'generator'
+  else:
+    kind = 'other'
+
+  # Components which misreport their __class__ (e.g. mocks, or old-style
+  # instances in Python 2) are classified individually.
+  if getattr(component, '__class__', None) is component_type:
+    try:
+      _COMPONENT_KINDS[component_type] = kind
+    except TypeError:
+      pass  # The type is not weakly referenceable.
+  return kind
+
+
 def Completions(component, verbose=False):
   """Gives possible Fire command completions for the component.
 
@@ -408,14 +609,15 @@ def Completions(component, verbose=False):
   Returns:
     A list of completions for a command that would so far return the component.
   """
-  if inspect.isroutine(component) or inspect.isclass(component):
-    spec = inspectutils.GetFullArgSpec(component)
+  kind = _ComponentKind(component)
+  if kind in ('routine', 'class'):
+    spec = _GetFullArgSpec(component)
     return _CompletionsFromArgs(spec.args + spec.kwonlyargs)
 
-  if isinstance(component, (tuple, list)):
+  if kind == 'sequence':
     return [str(index) for index in range(len(component))]
 
-  if inspect.isgenerator(component):
+  if kind == 'generator':
     # TODO(dbieber): There are currently no commands available for generators.
     return []
 
@@ -441,30 +643,52 @@ def _FormatForCommand(token):
   if not isinstance(token, six.string_types):
     token = str(token)
 
-  if token.startswith('_'):
-    return token
-
-  return token.replace('_', '-')
+  formatted = _FORMATTED_TOKENS.get(token)
+  if formatted is None:
+    if token.startswith('_'):
+      formatted = token
+    else:
+      formatted = token.replace('_', '-')
+    if len(_FORMATTED_TOKENS) >= _MAX_FORMATTED_TOKENS:
+      _FORMATTED_TOKENS.clear()
+    _FORMATTED_TOKENS[token] = formatted
+  return formatted
 
 
-def _Commands(component, depth=3):
+def _Commands(component, depth=3, seen=None, prefix=()):
   """Yields tuples representing commands.
 
   To use the command from Python, insert '.' between each element of the tuple.
   To use the command from the command line, insert ' ' between each element of
   the tuple.
 
+  A member reached again under the same name, e.g. a module imported by several
+  other modules, is not descended into again unless it now has more depth left.
+  The commands below it would only differ in their leading tokens, so they
+  would not add any completions: each completion depends only on the last two
+  tokens of a command.
+
   Args:
     component: The component considered to be the root of the yielded commands.
     depth: The maximum depth with which to traverse the member DAG for commands.
+    seen: A dict mapping (id(member), member_name) to a (member, depth) tuple
+        for each member already descended into and the depth it had left. The
+        member is stored so that its id is not reused during the traversal.
+    prefix: The tokens of the command leading to the component. Each yielded
+        command starts with these, so that the command is built in one step
+        rather than by prepending a token at every level of the recursion.
   Yields:
     Tuples, each tuple representing one possible command for this CLI.
     Only traverses the member DAG up to a depth of depth.
   """
-  if inspect.isroutine(component) or inspect.isclass(component):
+  if seen is None:
+    seen = {}
+
+  kind = _ComponentKind(component)
+  if kind in ('routine', 'class'):
     for completion in Completions(component, verbose=False):
-      yield (completion,)
-  if inspect.isroutine(component):
+      yield prefix + (completion,)
+  if kind == 'routine':
     return  # Don't descend into routines.
 
   if depth < 1:
@@ -473,13 +697,35 @@ def _Commands(component, depth=3):
   # By setting class_attrs={} we don't hide methods in completion.
   for member_name, member in VisibleMembers(component, class_attrs={},
                                             verbose=False):
-    # TODO(dbieber): Also skip components we've already seen.
     member_name = _FormatForCommand(member_name)
+    command = prefix + (member_name,)
+
+    yield command
+
+    key = (id(member), member_name)
+    if key in seen and seen[key][1] >= depth - 1:
+      continue
+    seen[key] = (member, depth - 1)
+
+    for subcommand in _Commands(member, depth - 1, seen, command):
+      yield subcommand
 
-    yield (member_name,)
 
-    for command in _Commands(member, depth - 1):
-      yield (member_name,) + command
+def _BuildMaps(name, component, default_options):
+  """Returns the sets of subcommands and options for the component's commands.
+
+  This is the only place the component's member DAG is walked; the Bash and
+  Fish scripts are both rendered from the resulting maps.
+
+  Args:
+    name: The name of the command, used as the first token of the commands.
+    component: The component considered to be the root of the commands.
+    default_options: A set of options that can be used with any command.
+  Returns:
+    The global_options, options_map, subcommands_map and commands_set as from
+    _GetMaps.
+  """
+  return _GetMaps(name, _Commands(component), default_options)
 
 
 def _IsOption(arg):
@@ -500,21 +746,27 @@ def _GetMaps(name, commands, default_options):
     global_options: A set of all options of the first token of the command.
     subcommands_map: A dict storing set of subcommands for each
         command/subcommand.
-    options_map: A dict storing set of options for each subcommand.
+    options_map: A dict storing set of options for each subcommand. The
+        default options, which apply to every subcommand, are not repeated in
+        each of these sets.
+    commands_set: A set of the command and of all subcommands that have
+        subcommands or options of their own.
   """
   global_options = copy.copy(default_options)
-  options_map = collections.defaultdict(lambda: copy.copy(default_options))
+  options_map = collections.defaultdict(set)
   subcommands_map = collections.defaultdict(set)
+  commands_set = {name}
 
   for command in commands:
     if len(command) == 1:
       if _IsOption(command[0]):
         global_options.add(command[0])
       else:
-        subcommands_map[name].add(command[0])
+        subcommands_map[name].add(_FormatForCommand(command[0]))
 
     elif command:
-      subcommand = command[-2]
+      # Subcommands are keyed only by the form in which they are completed.
+      subcommand = _FormatForCommand(command[-2])
       arg = _FormatForCommand(command[-1])
 
       if _IsOption(arg):
@@ -523,6 +775,6 @@ def _GetMaps(name, commands, default_options):
         args_map = subcommands_map
 
       args_map[subcommand].add(arg)
-      args_map[subcommand.replace('_', '-')].add(arg)
+      commands_set.add(subcommand)
 
-  return global_options, options_map, subcommands_map
+  return global_options, options_map, subcommands_map, commands_set
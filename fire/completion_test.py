@@ -18,6 +18,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import gc
+
 from fire import completion
 from fire import test_components as tc
 from fire import testutils
@@ -41,6 +43,36 @@ class TabCompletionTest(testutils.BaseTestCase):
     for last_command in ['command', 'halt']:
       self.assertIn(assert_template.format(command=last_command), script)
 
+  def testCompletionBashScriptUnderscoreCommands(self):
+    commands = [
+        ['run_all'],
+        ['run_all', '--dry_run'],
+    ]
+    script = completion._BashScript(name='command', commands=commands)  # pylint: disable=protected-access
+    self.assertIn('run-all)', script)
+    self.assertIn('--dry-run', script)
+    self.assertNotIn('run_all', script)
+
+  def testCompletionBashScriptIdentifier(self):
+    script = completion._BashScript(name='./my.tool,v2', commands=[['run']])  # pylint: disable=protected-access
+    self.assertIn('complete -F _complete-mytoolv2 ./my.tool,v2', script)
+
+  def testCompletionScriptsDeterministic(self):
+    commands = [
+        ['run'],
+        ['halt'],
+        ['halt', '--now'],
+        ['halt', '--force'],
+    ]
+    script = completion._BashScript(name='command', commands=commands)  # pylint: disable=protected-access
+    self.assertLess(script.index('command)'), script.index('halt)'))
+    self.assertIn('opts="halt run ${GLOBAL_OPTIONS}"', script)
+    self.assertIn('opts="--force --now ${GLOBAL_OPTIONS}"', script)
+
+    script = completion._FishScript(name='command', commands=commands)  # pylint: disable=protected-access
+    self.assertLess(script.index('-a halt'), script.index('-a run'))
+    self.assertLess(script.index('-l force'), script.index('-l now'))
+
   def testCompletionFishScript(self):
     # A sanity check test to make sure the fish completion script satisfies
     # some basic assumptions.
@@ -54,6 +86,23 @@ class TabCompletionTest(testutils.BaseTestCase):
     self.assertIn('halt', script)
     self.assertIn('-l now', script)
 
+  def testCompletionFishScriptStripsOnlyFlagPrefix(self):
+    commands = [
+        ['halt'],
+        ['halt', '---now'],
+    ]
+    script = completion._FishScript(name='command', commands=commands)  # pylint: disable=protected-access
+    self.assertIn('-l -now', script)
+
+  def testCompletionFishScriptWithBraces(self):
+    commands = [
+        ['{run}'],
+        ['{run}', '--now'],
+    ]
+    script = completion._FishScript(name='command', commands=commands)  # pylint: disable=protected-access
+    self.assertIn('-a {run}', script)
+    self.assertIn('-l now', script)
+
   def testFnCompletions(self):
     def example(one, two, three):
       return one, two, three
@@ -129,6 +178,13 @@ class TabCompletionTest(testutils.BaseTestCase):
     self.assertIn('--alpha', script)
     self.assertIn('--beta', script)
 
+  def testScriptCachedPerArguments(self):
+    script = completion.Script('identity', tc.identity)
+    self.assertIs(completion.Script('identity', tc.identity), script)
+    fish_script = completion.Script('identity', tc.identity, shell='fish')
+    self.assertIsNot(fish_script, script)
+    self.assertIn('arg1', fish_script)
+
   def testDeepDictFishScript(self):
     deepdict = {'level1': {'level2': {'level3': {'level4': {}}}}}
     script = completion.Script('deepdict', deepdict, shell='fish')
@@ -144,6 +200,13 @@ class TabCompletionTest(testutils.BaseTestCase):
     self.assertIn('arg3', script)
     self.assertIn('arg4', script)
 
+  def testFnFishScriptRootFlags(self):
+    script = completion.Script('identity', tc.identity, shell='fish')
+    self.assertIn(
+        "__fish_using_command identity; and __option_entered_check --arg1'",
+        script)
+    self.assertIn('-l arg1', script)
+
   def testClassFishScript(self):
     script = completion.Script('', tc.MixedDefaults, shell='fish')
     self.assertIn('ten', script)
@@ -183,6 +246,48 @@ class TabCompletionTest(testutils.BaseTestCase):
     self.assertIn('double', completions)
     self.assertIn('triple', completions)
 
+  def testCompletionsCacheEvictedWithComponent(self):
+    def example(one, two):
+      return one, two
+
+    key = id(example)
+    self.assertEqual(completion.Completions(example), ['--one', '--two'])
+    self.assertIn(key, completion._ARGSPEC_CACHE)  # pylint: disable=protected-access
+    self.assertEqual(completion.Completions(example), ['--one', '--two'])
+    del example
+    self.assertNotIn(key, completion._ARGSPEC_CACHE)  # pylint: disable=protected-access
+
+    class Example(object):
+
+      def __init__(self, one):
+        self.one = one
+
+    key = id(Example)
+    self.assertEqual(completion.Completions(Example), ['--one'])
+    self.assertIn(key, completion._ARGSPEC_CACHE)  # pylint: disable=protected-access
+    self.assertEqual(completion.VisibleMembers(Example), [])
+    del Example
+    gc.collect()
+    self.assertNotIn(key, completion._ARGSPEC_CACHE)  # pylint: disable=protected-access
+
+  def testObjectCompletionsSkipHiddenLookups(self):
+    class Component(object):
+      """A component whose hidden properties raise when looked up."""
+
+      @property
+      def __unreachable__(self):
+        raise ValueError('Dunder members should not be looked up.')
+
+      @property
+      def _private(self):
+        raise ValueError('Private members should not be looked up.')
+
+      def double(self, count):
+        return 2 * count
+
+    completions = completion.Completions(Component())
+    self.assertEqual(completions, ['double'])
+
   def testMethodCompletions(self):
     completions = completion.Completions(tc.NoDefaults().double)
     self.assertNotIn('--self', completions)